@@ -1,8 +1,11 @@
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+import asyncio
 import os
+import threading
 from dotenv import load_dotenv
 from typing import List, Dict, Any
-from datetime import datetime
+from datetime import datetime, timedelta
 from Logger import Logger
 
 load_dotenv()
@@ -10,37 +13,93 @@ load_dotenv()
 
 class Database:
     _instance = None
+    _lock = threading.Lock()
 
     def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super(Database, cls).__new__(cls)
-            cls._instance._initialized = False
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = super(Database, cls).__new__(cls)
+                cls._instance._initialized = False
         return cls._instance
 
     def __init__(self):
-        if self._initialized:
-            return
+        with self._lock:
+            if self._initialized:
+                return
 
-        self.client = None
-        self.db = None
-        self.queue_collection = None
-        self._initialized = True
+            self.client = None
+            self.db = None
+            self.queue_collection = None
+            self._connect_lock = None
+            self._initialized = True
 
     async def connect(self):
-        """Connect to MongoDB database"""
-        if not self.client:
-            try:
-                self.client = AsyncIOMotorClient(os.getenv('MONGO_URI'), serverSelectionTimeoutMS=10000)
-                await self.client.server_info()  # Verify connection
-                self.db = self.client['santosh-gmaps']
-                self.queue_collection = self.db['queue']
+        """Connect to MongoDB database, concurrent callers share a single connection"""
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
 
-                # Create index on scraped field for efficient querying
-                await self.queue_collection.create_index('scraped')
+        async with self._connect_lock:
+            if self.client:
+                return
 
-                Logger.info("Successfully connected to MongoDB")
+            try:
+                client = AsyncIOMotorClient(os.getenv('MONGO_URI'), serverSelectionTimeoutMS=10000)
+                await client.server_info()  # Verify connection
             except Exception as e:
                 Logger.error(f"Failed to connect to MongoDB: {str(e)}")
+                return
+
+            self.client = client
+            self.db = self.client['santosh-gmaps']
+            self.queue_collection = self.db['queue']
+
+            try:
+                # Compound index for the scraper's queue filter
+                await self.queue_collection.create_index([('scraped', 1), ('retry_count', 1)])
+
+                # Compound index for the image downloader's queue filter
+                await self.queue_collection.create_index([('scraped', 1), ('images_scraped', 1), ('retry_count', 1)])
+            except Exception as e:
+                Logger.error("Failed to create indexes on the queue collection", e)
+
+            Logger.info("Successfully connected to MongoDB")
+
+    async def claim_batch(self, query: Dict[str, Any], limit: int, projection: Dict[str, Any] | None = None,
+                          claim_timeout: int = 600) -> List[Dict[str, Any]]:
+        """
+        Atomically claim up to `limit` queue documents matching the query by marking them in progress.
+        Only the fields in `projection` are returned, or the whole document if it is None.
+        Claims older than `claim_timeout` seconds are treated as abandoned and can be claimed again.
+        """
+        now = datetime.utcnow()
+        claim_query = {
+            **query,
+            '$or': [
+                {'processing_status': {'$ne': 'in_progress'}},
+                {'claimed_at': {'$lt': now - timedelta(seconds=claim_timeout)}}
+            ]
+        }
+
+        claimed = await asyncio.gather(*[
+            self.queue_collection.find_one_and_update(
+                claim_query,
+                {'$set': {'processing_status': 'in_progress', 'claimed_at': now}},
+                projection=projection,
+                return_document=ReturnDocument.AFTER
+            )
+            for _ in range(limit)
+        ])
+        return [record for record in claimed if record is not None]
+
+    async def release_claims(self, record_ids: List[Any]):
+        """
+        Hand claimed queue documents back without counting an attempt
+        """
+        if record_ids:
+            await self.queue_collection.update_many(
+                {'_id': {'$in': record_ids}, 'processing_status': 'in_progress'},
+                {'$set': {'processing_status': 'pending'}, '$unset': {'claimed_at': ''}}
+            )
 
     async def close(self):
         """Close the database connection"""
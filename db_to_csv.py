@@ -1,20 +1,44 @@
-import pandas as pd
+import csv
 import asyncio
+from typing import List
 
 from db import Database
 
+# Queue document fields in insertion order, followed by the ones added by the workers
+FIELDS = [
+    '_id', 'city_id', 'link', 'website', 'title', 'section_id',
+    'scraped', 'images_scraped', 'processing_status', 'retry_count',
+    'address', 'image_url', 'image_filename', 'claimed_at',
+]
+
+
+async def get_field_names(collection) -> List[str]:
+    """
+    Collect every field name used in the collection, known queue fields first
+    """
+    pipeline = [
+        {'$project': {'fields': {'$objectToArray': '$$ROOT'}}},
+        {'$unwind': '$fields'},
+        {'$group': {'_id': '$fields.k'}},
+    ]
+    names = {doc['_id'] async for doc in collection.aggregate(pipeline)}
+    return [name for name in FIELDS if name in names] + sorted(names - set(FIELDS))
+
 
 async def main():
     db = Database()
     await db.connect()
-    data = list
 
-    # Fetch data from the collection
-    data = list(db.queue_collection.find({}))
+    fieldnames = await get_field_names(db.queue_collection)
+
+    # Stream documents from the collection and write them to CSV as they arrive
+    with open("output.csv", "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        async for doc in db.queue_collection.find({}, batch_size=5000):
+            writer.writerow(doc)
 
-    # Create a DataFrame and save it as CSV
-    df = pd.DataFrame(data)
-    df.to_csv("output.csv", index=False)
+    await db.close()
 
 
 if __name__ == "__main__":
@@ -1,20 +1,24 @@
-import time
 import os
 import uuid
+import aiofiles
 import aiohttp
 import asyncio
 from typing import Dict, List, Any
+from pymongo import UpdateOne
 from Logger import Logger
 from db import Database
 
 
 class ParallelImageDownloader:
-    def __init__(self, batch_size: int = 10, timeout: int = 10, max_retries: int = 3, batch_delay: int = 5):
+    def __init__(self, batch_size: int = 10, timeout: int = 10, max_retries: int = 3, batch_delay: int = 5,
+                 max_concurrency: int = 20):
         self.db = Database()
         self.batch_size = batch_size
         self.timeout = timeout
         self.max_retries = max_retries
         self.batch_delay = batch_delay
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
         self.session = None
         self.total_processed = 0
         self.images_dir = 'images'
@@ -47,70 +51,77 @@ class ParallelImageDownloader:
                 filename = f"{uuid.uuid4()}.{file_extension}"
                 filepath = os.path.join(self.images_dir, filename)
 
-                # Save image
-                content = await response.read()
-                with open(filepath, 'wb') as f:
-                    f.write(content)
+                # Stream image to disk in chunks, removing the partial file if the download fails
+                try:
+                    async with aiofiles.open(filepath, 'wb') as f:
+                        async for chunk in response.content.iter_chunked(65536):
+                            await f.write(chunk)
+                except BaseException:
+                    if os.path.exists(filepath):
+                        os.remove(filepath)
+                    raise
 
                 return filename
 
         except Exception as e:
             raise Exception(f"Error downloading image: {str(e)}")
 
-    async def process_record(self, record: Dict[str, Any]) -> Dict[str, Any] | None:
+    async def process_record(self, record: Dict[str, Any]) -> UpdateOne:
         """
         Process a single record
+        Returns the status update to write for the record
         """
+        record_id = record['_id']
         try:
-            record_id = record['_id']
             image_url = record['image_url']
 
-            # Download image
-            image_filename = await self.download_image(image_url)
+            # Download image, bounded by the concurrency limit
+            async with self.semaphore:
+                image_filename = await self.download_image(image_url)
 
-            # Update record
             update_data = {
                 'images_scraped': True,
                 'image_filename': image_filename,
                 'processing_status': 'processed'
             }
 
-            await self.db.queue_collection.update_one(
-                {'_id': record_id},
-                {
-                    '$set': update_data,
-                    '$inc': {'retry_count': 1}
-                }
-            )
-
             Logger.info(f"Successfully downloaded image for record {record_id}")
             self.total_processed += 1
-            return record_id
 
         except Exception as e:
-            await self.db.queue_collection.update_one(
-                {'_id': record['_id']},
-                {
-                    '$set': {
-                        'processing_status': 'failed',
-                    },
-                    '$inc': {'retry_count': 1}
-                }
-            )
+            update_data = {
+                'processing_status': 'failed',
+            }
 
-            Logger.error(f"Error processing record {record['_id']}", e)
-            return None
+            Logger.error(f"Error processing record {record_id}", e)
+
+        # One update records the outcome and counts the attempt
+        return UpdateOne(
+            {'_id': record_id},
+            {
+                '$set': update_data,
+                '$inc': {'retry_count': 1}
+            }
+        )
 
     async def process_batch(self, batch: List[Dict[str, Any]]):
         """
         Process a batch of records concurrently using asyncio.gather
+        and write their status updates in a single bulk_write
         """
         tasks = [
             self.process_record(record)
             for record in batch if record['retry_count'] < self.max_retries
         ]
 
-        await asyncio.gather(*tasks, return_exceptions=True)
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        operations = [result for result in results if isinstance(result, UpdateOne)]
+        if operations:
+            try:
+                await self.db.queue_collection.bulk_write(operations, ordered=False)
+            except Exception as e:
+                Logger.error(f"Error writing status updates for {len(operations)} records", e)
 
     async def run(self):
         """
@@ -120,8 +131,13 @@ class ParallelImageDownloader:
             # Connect to database
             await self.db.connect()
 
-            # Initialize aiohttp session
-            self.session = aiohttp.ClientSession()
+            # Initialize aiohttp session with a pool sized to the concurrency limit, caching DNS lookups
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.max_concurrency,
+                    ttl_dns_cache=300
+                )
+            )
 
             Logger.info("Starting parallel image downloading process")
 
@@ -143,12 +159,12 @@ class ParallelImageDownloader:
             while True:
                 batch_number += 1
 
-                # Get batch of unprocessed records
-                batch = await self.db.queue_collection.find({
+                # Claim batch of unprocessed records
+                batch = await self.db.claim_batch({
                     'images_scraped': False,
                     'scraped': True,
                     'retry_count': {'$lt': self.max_retries}
-                }).limit(self.batch_size).to_list(length=self.batch_size)
+                }, self.batch_size, projection={'image_url': 1, 'retry_count': 1})
 
                 if not batch:
                     break
@@ -169,7 +185,7 @@ class ParallelImageDownloader:
                     }
                 )
                 Logger.info(f'Sleeping for {self.batch_delay} seconds')
-                time.sleep(self.batch_delay)
+                await asyncio.sleep(self.batch_delay)
 
             processed = await self.db.queue_collection.count_documents({
                 'images_scraped': True
@@ -191,6 +207,7 @@ async def main():
         timeout=15,
         max_retries=8,
         batch_delay=0,
+        max_concurrency=20,
     )
     await downloader.run()
 
@@ -1,6 +1,7 @@
 import pandas as pd
 from typing import Dict, Any, List
 import asyncio
+from pymongo.errors import BulkWriteError
 from db import Database
 from tqdm import tqdm
 from Logger import Logger
@@ -11,31 +12,19 @@ class InsertDataManager:
         self.batch_size = batch_size
         self.db = Database()
 
-    def process_row(self, row: Dict[str, Any]) -> Dict[str, Any]:
+    def process_rows(self, batch_df: pd.DataFrame) -> List[Dict[str, Any]]:
         """
-        Process a single row of data into the format we want to store
+        Process a batch of rows into the format we want to store
         """
-        return {
-            'city_id': str(row['city_id']),
-            'link': row['link'],
-            'website': row['website'],
-            'title': row['title'],
-            'section_id': str(row['section_id']),
-            'scraped': False,
-            'images_scraped': False,
-            'processing_status': 'pending',
-            'retry_count': 0
-        }
-
-    async def get_existing_links(self, links: List[str]) -> set:
-        """
-        Get existing links from MongoDB
-        """
-        existing_records = await self.db.queue_collection.find(
-            {'link': {'$in': links}},
-            {'link': 1}
-        ).to_list(None)
-        return {record['link'] for record in existing_records}
+        return batch_df[['city_id', 'link', 'website', 'title', 'section_id']].astype({
+            'city_id': str,
+            'section_id': str
+        }).assign(
+            scraped=False,
+            images_scraped=False,
+            processing_status='pending',
+            retry_count=0
+        ).to_dict('records')
 
     async def process_csv(self, input_file: str) -> None:
         """
@@ -45,6 +34,10 @@ class InsertDataManager:
             # Connect to database
             await self.db.connect()
 
+            # Unique index on link so duplicate inserts are rejected by MongoDB,
+            # inserts rely on it to skip duplicates so a failure here aborts the upload
+            await self.db.queue_collection.create_index('link', unique=True)
+
             # Read CSV file and drop duplicates within the CSV itself
             Logger.info('Reading CSV file...')
             df = pd.read_csv(
@@ -80,29 +73,25 @@ class InsertDataManager:
                     batch_end = min(batch_start + self.batch_size, total_rows)
                     batch_df = df.iloc[batch_start:batch_end]
 
-                    # Get all links in current batch
-                    batch_links = batch_df['link'].tolist()
-
-                    # Check which links already exist in MongoDB
-                    existing_links = await self.get_existing_links(batch_links)
-
-                    # Process only new records
-                    batch_data = []
-                    for _, row in batch_df.iterrows():
-                        if row['link'] not in existing_links:
-                            processed_row = self.process_row(row.to_dict())
-                            batch_data.append(processed_row)
-                        else:
-                            skipped += 1
-
-                    # Insert batch if there are new records
-                    if batch_data:
-                        try:
-                            await self.db.queue_collection.insert_many(batch_data)
-                            processed += len(batch_data)
-                        except Exception as e:
-                            Logger.error(f"Error inserting batch {batch_start // self.batch_size + 1}", e)
-                            continue
+                    batch_data = self.process_rows(batch_df)
+
+                    # Insert batch, the unique index on 'link' rejects records that already exist
+                    try:
+                        result = await self.db.queue_collection.insert_many(batch_data, ordered=False)
+                        processed += len(result.inserted_ids)
+                    except BulkWriteError as e:
+                        processed += e.details['nInserted']
+                        write_errors = e.details['writeErrors']
+                        duplicates = sum(1 for error in write_errors if error['code'] == 11000)
+                        skipped += duplicates
+                        if duplicates < len(write_errors):
+                            Logger.error(
+                                f"Error inserting {len(write_errors) - duplicates} records "
+                                f"in batch {batch_start // self.batch_size + 1}"
+                            )
+                    except Exception as e:
+                        Logger.error(f"Error inserting batch {batch_start // self.batch_size + 1}", e)
+                        continue
 
                     # Update progress bar for both processed and skipped records
                     pbar.update(len(batch_df))
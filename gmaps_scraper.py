@@ -1,80 +1,152 @@
-import time
-
 from db import Database
 from Logger import Logger
 from typing import Dict, List, Any
+from pymongo import UpdateOne
 import aiohttp
-from bs4 import BeautifulSoup
+from lxml import etree, html as lxml_html
 import asyncio
+import html
+import itertools
+import re
+from yarl import URL
+
+# Last byte requested when fetching only the start of a page
+HEAD_RANGE_BYTES = 16384
+
+# Fast path: complete <meta> tags, the closing '>' shows a tag was not cut off by a partial response
+META_TAG_PATTERN = re.compile(rb'<meta\b(?:[^>"\']|"[^"]*"|\'[^\']*\')*>', re.IGNORECASE)
+
+# property and content attributes inside a single <meta> tag, double or single quoted
+META_ATTRIBUTE_PATTERN = re.compile(rb'\s(property|content)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')', re.IGNORECASE)
+
+# Both og meta tags are selected in one compiled tree walk
+OG_META_XPATH = etree.XPath('//meta[@property="og:title" or @property="og:image"]')
 
 
 class ParallelScraper:
-    def __init__(self, batch_size: int = 10, timeout: int = 10, max_retries: int = 3, batch_delay: int = 5):
+    def __init__(self, batch_size: int = 10, timeout: int = 10, max_retries: int = 3, batch_delay: int = 5,
+                 max_concurrency: int = 8, max_per_proxy: int = 4):
         self.db = Database()
         self.batch_size = batch_size
         self.timeout = timeout
         self.max_retries = max_retries
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
         self.proxies = self.load_proxies_from_file('proxies.txt')
-        self.current_proxy_index = 0
+        # Each proxy carries its own semaphore so load is spread evenly across them
+        self.proxy_cycle = itertools.cycle([(proxy, asyncio.Semaphore(max_per_proxy)) for proxy in self.proxies])
         self.session = None
         self.total_processed = 0
         self.batch_delay = batch_delay
         Logger.info(f"Initialized scraper with {len(self.proxies)} proxies")
 
-    def load_proxies_from_file(self, file_name: str) -> list[str]:
+    def load_proxies_from_file(self, file_name: str) -> list[URL]:
         proxies = []
         with open(file_name, 'r') as file:
             for line in file:
                 parts = line.strip().split(':')
                 if len(parts) == 4:
-                    proxy_url = f"http://{parts[2]}:{parts[3]}@{parts[0]}:{parts[1]}"
+                    # Parsed once here so aiohttp does not re-parse the proxy string on every request
+                    proxy_url = URL(f"http://{parts[2]}:{parts[3]}@{parts[0]}:{parts[1]}")
                     proxies.append(proxy_url)
         return proxies
 
+    @staticmethod
+    def has_meta(meta: Dict[str, str]) -> bool:
+        """
+        Check that both og meta tags were found with a value
+        """
+        return bool(meta.get('og:title')) and bool(meta.get('og:image'))
+
+    @staticmethod
+    def match_meta(body: bytes) -> Dict[str, str]:
+        """
+        Extract og meta tags from raw HTML bytes with the regex fast path
+        Attributes are read from each complete <meta> tag in any order
+        """
+        meta = {}
+        for tag in META_TAG_PATTERN.findall(body):
+            attributes = {
+                name.lower(): double_quoted or single_quoted
+                for name, double_quoted, single_quoted in META_ATTRIBUTE_PATTERN.findall(tag)
+            }
+            if attributes.get(b'property') in (b'og:title', b'og:image') and b'content' in attributes:
+                meta[attributes[b'property'].decode()] = html.unescape(
+                    attributes[b'content'].decode('utf-8', errors='replace')
+                )
+        return meta
+
+    @staticmethod
+    def parse_meta(body: bytes) -> Dict[str, str]:
+        """
+        Extract og meta tags from raw HTML bytes with a full lxml parse
+        """
+        # Parse raw bytes so lxml detects the encoding itself
+        tree = lxml_html.fromstring(body)
+        return {element.get('property'): element.get('content') for element in OG_META_XPATH(tree)}
+
+    async def fetch_page(self, url: str, proxy_url: URL, headers: Dict[str, str] | None = None) -> tuple[int, bytes]:
+        """
+        Fetch the raw HTML of a page through the given proxy
+        Returns the response status and body
+        """
+        async with self.session.get(
+                url,
+                proxy=proxy_url,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers=headers
+        ) as response:
+            if response.status not in (200, 206):
+                raise Exception(f"HTTP {response.status}")
+
+            return response.status, await response.read()
+
     async def fetch_url_data(self, url: str) -> Dict[str, str]:
         """
         Fetch and parse data from the provided URL using aiohttp
         """
         try:
-            proxy_url = self.proxies[self.current_proxy_index]
-            self.current_proxy_index = (self.current_proxy_index + 1) % len(self.proxies)
-
-            async with self.session.get(
-                    url,
-                    proxy=proxy_url,
-                    timeout=aiohttp.ClientTimeout(total=self.timeout),
-                    headers={
-                        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/130.0.0.0 Safari/537.36'
-                    }
-            ) as response:
-                if response.status != 200:
-                    raise Exception(f"HTTP {response.status}")
-
-                html = await response.text()
-                soup = BeautifulSoup(html, 'html.parser')
-
-                address = soup.select_one('meta[property="og:title"]').get('content')
-                image_url = soup.select_one('meta[property="og:image"]').get('content')
-
-                return {
-                    'address': address,
-                    'image_url': image_url,
-                }
+            proxy_url, proxy_semaphore = next(self.proxy_cycle)
+
+            async with proxy_semaphore:
+                # The og meta tags sit in the <head>, so only ask for the start of the page
+                status, body = await self.fetch_page(url, proxy_url, {'Range': f'bytes=0-{HEAD_RANGE_BYTES}'})
+                meta = self.match_meta(body)
+
+                # Partial content may have cut the tags off, fall back to the full page
+                if status == 206 and not self.has_meta(meta):
+                    status, body = await self.fetch_page(url, proxy_url)
+                    meta = self.match_meta(body)
+
+                # lxml recovers tags truncated by a partial body, so only a full page is parsed,
+                # in a worker thread to keep the event loop free for other fetches
+                if status == 200 and not self.has_meta(meta):
+                    meta = await asyncio.to_thread(self.parse_meta, body)
+
+            if not self.has_meta(meta):
+                raise Exception("og:title or og:image meta tag not found")
+
+            return {
+                'address': meta['og:title'],
+                'image_url': meta['og:image'],
+            }
 
         except Exception as e:
             raise Exception(f"Error extracting data from HTML: {str(e)}")
 
-    async def process_record(self, record: Dict[str, Any]) -> Dict[str, Any] | None:
+    async def process_record(self, record: Dict[str, Any]) -> UpdateOne:
         """
         Process a single record
+        Returns the status update to write for the record
         """
+        record_id = record['_id']
         try:
             url = record['link']
-            record_id = record['_id']
 
-            scraped_data = await self.fetch_url_data(url)
+            # Fetch page, bounded by the concurrency limit
+            async with self.semaphore:
+                scraped_data = await self.fetch_url_data(url)
 
-            # Update record
             update_data = {
                 'scraped': True,
                 'processing_status': 'processed',
@@ -82,42 +154,62 @@ class ParallelScraper:
                 'image_url': scraped_data['image_url'],
             }
 
-            await self.db.queue_collection.update_one(
-                {'_id': record_id},
-                {
-                    '$set': update_data,
-                    '$inc': {'retry_count': 1}
-                }
-            )
-
             Logger.info(f"Successfully processed record {record_id}")
             self.total_processed += 1
-            return record_id
 
         except Exception as e:
-            await self.db.queue_collection.update_one(
-                {'_id': record['_id']},
-                {
-                    '$set': {
-                        'processing_status': 'failed',
-                    },
-                    '$inc': {'retry_count': 1}
-                }
-            )
+            update_data = {
+                'processing_status': 'failed',
+            }
+
+            Logger.error(f"Error processing record {record_id}", e)
 
-            Logger.error(f"Error processing record {record['_id']}", e)
-            return None
+        # One update records the outcome and counts the attempt
+        return UpdateOne(
+            {'_id': record_id},
+            {
+                '$set': update_data,
+                '$inc': {'retry_count': 1}
+            }
+        )
 
     async def process_batch(self, batch: List[Dict[str, Any]]):
         """
         Process a batch of records concurrently using asyncio.gather
+        and write their status updates in a single bulk_write
         """
         tasks = [
             self.process_record(record)
             for record in batch if record['retry_count'] < self.max_retries
         ]
 
-        await asyncio.gather(*tasks, return_exceptions=True)
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        operations = [result for result in results if isinstance(result, UpdateOne)]
+        if operations:
+            try:
+                await self.db.queue_collection.bulk_write(operations, ordered=False)
+            except Exception as e:
+                Logger.error(f"Error writing status updates for {len(operations)} records", e)
+
+    async def fetch_batch(self) -> List[Dict[str, Any]]:
+        """
+        Claim a batch of unscraped records
+        """
+        return await self.db.claim_batch({
+            'scraped': False,
+            'retry_count': {'$lt': self.max_retries}
+        }, self.batch_size, projection={'link': 1, 'retry_count': 1})
+
+    async def release_prefetch(self, next_batch_task: asyncio.Task):
+        """
+        Wait for a prefetch that was left behind and hand its claimed records back to the queue
+        """
+        try:
+            batch = await next_batch_task
+            await self.db.release_claims([record['_id'] for record in batch])
+        except Exception as e:
+            Logger.error("Error releasing prefetched batch", e)
 
     async def run(self):
         """
@@ -127,8 +219,18 @@ class ParallelScraper:
             # Connect to database
             await self.db.connect()
 
-            # Initialize aiohttp session
-            self.session = aiohttp.ClientSession()
+            # Initialize aiohttp session with a pool sized to the concurrency limit,
+            # caching DNS lookups and keeping idle connections open across the batch delay
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.max_concurrency,
+                    ttl_dns_cache=300,
+                    keepalive_timeout=75
+                ),
+                headers={
+                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/130.0.0.0 Safari/537.36'
+                }
+            )
 
             Logger.info("Starting parallel scraping process")
 
@@ -146,35 +248,40 @@ class ParallelScraper:
 
             # Process in batches
             batch_number = 0
-            while True:
-                batch_number += 1
-
-                # Get batch of unscraped records
-                batch = await self.db.queue_collection.find({
-                    'scraped': False,
-                    'retry_count': {'$lt': self.max_retries}
-                }).limit(self.batch_size).to_list(length=self.batch_size)
-
-                if not batch:
-                    break
-
-                Logger.debug(f"Starting batch {batch_number}")
-                await self.process_batch(batch)
-
-                # Calculate and log progress
-                progress = (self.total_processed / total_unscraped) * 100
-
-                Logger.info(
-                    "Progress Update",
-                    {
-                        'batch_number': batch_number,
-                        'progress_percentage': f"{progress:.2f}%",
-                        'records_processed': self.total_processed,
-                        'total_records': total_unscraped,
-                    }
-                )
-                Logger.info(f'Sleeping for {self.batch_delay} seconds')
-                time.sleep(self.batch_delay)
+            batch = await self.fetch_batch()
+            next_batch_task = None
+            try:
+                while batch:
+                    batch_number += 1
+
+                    # Claim the next batch while the current one is being processed
+                    next_batch_task = asyncio.create_task(self.fetch_batch())
+
+                    Logger.debug(f"Starting batch {batch_number}")
+                    await self.process_batch(batch)
+
+                    # Calculate and log progress
+                    progress = (self.total_processed / total_unscraped) * 100
+
+                    Logger.info(
+                        "Progress Update",
+                        {
+                            'batch_number': batch_number,
+                            'progress_percentage': f"{progress:.2f}%",
+                            'records_processed': self.total_processed,
+                            'total_records': total_unscraped,
+                        }
+                    )
+                    Logger.info(f'Sleeping for {self.batch_delay} seconds')
+                    await asyncio.sleep(self.batch_delay)
+
+                    # Records that failed in this batch were still claimed during the prefetch, so look again before stopping
+                    batch = await next_batch_task
+                    next_batch_task = None
+                    batch = batch or await self.fetch_batch()
+            finally:
+                if next_batch_task is not None:
+                    await self.release_prefetch(next_batch_task)
 
             processed = await self.db.queue_collection.count_documents({
                 'scraped': True
@@ -196,6 +303,8 @@ async def main():
         timeout=10,
         max_retries=5,
         batch_delay=5,
+        max_concurrency=8,
+        max_per_proxy=4,
     )
     await scraper.run()
 